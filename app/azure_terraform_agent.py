@@ -1,7 +1,10 @@
 import os
+import asyncio
+import itertools
+import threading
+from typing import Iterator, List, Optional
 import streamlit as st
 from dotenv import load_dotenv
-from rag_engine import TerraformRAGEngine
 
 # Set page config first
 st.set_page_config(
@@ -10,15 +13,34 @@ st.set_page_config(
     layout="wide"
 )
 
-# Load environment variables
-load_dotenv()
+@st.cache_resource(show_spinner=False)
+def _load_env() -> str:
+    """Load environment variables once per process rather than on every rerun."""
+    load_dotenv()
+    return os.getenv('OPENAI_API_KEY')
 
-# Debug: Print the API key (first few characters)
-api_key = os.getenv('OPENAI_API_KEY')
-if api_key:
-    st.sidebar.success(f"API Key loaded (first 10 chars): {api_key[:10]}...")
-else:
+api_key = _load_env()
+
+# Debug: Print the API key (first few characters) once per session
+if not api_key:
     st.sidebar.error("No API key found in environment variables")
+elif "env_shown" not in st.session_state:
+    st.sidebar.success(f"API Key loaded (first 10 chars): {api_key[:10]}...")
+    st.session_state.env_shown = True
+
+# Number of most recent chat messages rendered on each rerun
+HISTORY_WINDOW = 20
+
+@st.cache_resource(show_spinner=False)
+def _get_event_loop() -> asyncio.AbstractEventLoop:
+    """Run one event loop per process in a daemon thread.
+
+    The cached engine's async OpenAI client keeps pooled connections bound to
+    the loop that opened them, so every request must run on the same loop.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="terraform-agent-loop", daemon=True).start()
+    return loop
 
 class AzureTerraformAgent:
     def __init__(self):
@@ -31,11 +53,27 @@ class AzureTerraformAgent:
         if not os.path.exists(self.template_dir):
             raise FileNotFoundError(f"Template directory not found: {self.template_dir}")
         
+        # Imported here so the page renders before LangChain loads
+        from rag_engine import TerraformRAGEngine
         self.rag_engine = TerraformRAGEngine(self.template_dir)
 
-    def generate_terraform(self, user_input: str) -> str:
-        """Generate Terraform configuration using RAG approach."""
-        return self.rag_engine.generate_terraform(user_input)
+    def generate_terraform_stream(self, user_input: str, notices: Optional[List[str]] = None) -> Iterator[str]:
+        """Stream Terraform configuration chunks synchronously for Streamlit."""
+        loop = _get_event_loop()
+        stream = self.rag_engine.generate_terraform_stream(user_input, notices)
+        try:
+            while True:
+                try:
+                    yield asyncio.run_coroutine_threadsafe(stream.__anext__(), loop).result()
+                except StopAsyncIteration:
+                    break
+        finally:
+            asyncio.run_coroutine_threadsafe(stream.aclose(), loop).result()
+
+@st.cache_resource
+def _get_agent() -> AzureTerraformAgent:
+    """Build the agent once per process instead of on every Streamlit rerun."""
+    return AzureTerraformAgent()
 
 # Streamlit UI Component
 def azure_terraform_chat():
@@ -59,7 +97,7 @@ def azure_terraform_chat():
     """)
     
     try:
-        agent = AzureTerraformAgent()
+        agent = _get_agent()
     except Exception as e:
         st.error(f"Failed to initialize Azure Terraform Agent: {str(e)}")
         st.stop()
@@ -67,8 +105,18 @@ def azure_terraform_chat():
     if "messages" not in st.session_state:
         st.session_state.messages = []
     
-    # Display chat history
-    for message in st.session_state.messages:
+    # Display chat history, rendering only the most recent messages by default
+    messages = st.session_state.messages
+    earlier_count = max(len(messages) - HISTORY_WINDOW, 0)
+    if earlier_count:
+        st.caption(f"{earlier_count} earlier messages hidden")
+        # Static label: older Streamlit versions derive the widget ID from it
+        if st.checkbox("Show earlier messages", key="show_earlier_messages"):
+            for message in messages[:earlier_count]:
+                with st.chat_message(message["role"]):
+                    st.markdown(message["content"])
+
+    for message in messages[earlier_count:]:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
     
@@ -79,54 +127,65 @@ def azure_terraform_chat():
         with st.chat_message("user"):
             st.markdown(prompt)
         
-        with st.spinner("Processing your request..."):
+        try:
+            # Wait for the first chunk so out-of-scope queries are rejected before rendering
+            notices: List[str] = []
+            stream = agent.generate_terraform_stream(prompt, notices)
             try:
-                # Generate Terraform code
-                terraform_code = agent.generate_terraform(prompt)
+                with st.spinner("Processing your request..."):
+                    first_chunk = next(stream, "")
+            finally:
+                # The engine runs on a background loop, so its notices are rendered here
+                for notice in notices:
+                    st.error(notice)
+
+            # Display generated code as it streams in
+            with st.chat_message("assistant"):
+                st.markdown("### Generated Terraform Configuration")
+                code_placeholder = st.empty()
+                terraform_code = ""
+                for chunk in itertools.chain([first_chunk], stream):
+                    terraform_code += chunk
+                    code_placeholder.code(terraform_code, language='hcl')
+                
+                # Add download button
+                st.download_button(
+                    label="Download Terraform Configuration",
+                    data=terraform_code,
+                    file_name="main.tf",
+                    mime="text/plain"
+                )
+                
+                st.session_state.messages.append({
+                    "role": "assistant",
+                    "content": f"Generated Terraform Configuration:\n```hcl\n{terraform_code}\n```"
+                })
                 
-                # Display generated code
-                with st.chat_message("assistant"):
-                    st.markdown("### Generated Terraform Configuration")
-                    st.code(terraform_code, language='hcl')
-                    
-                    # Add download button
-                    st.download_button(
-                        label="Download Terraform Configuration",
-                        data=terraform_code,
-                        file_name="main.tf",
-                        mime="text/plain"
-                    )
-                    
-                    st.session_state.messages.append({
-                        "role": "assistant",
-                        "content": f"Generated Terraform Configuration:\n```hcl\n{terraform_code}\n```"
-                    })
-                    
-                    st.info("""
-                    To use this configuration:
-                    1. Download the generated Terraform file
-                    2. Initialize Terraform: `terraform init`
-                    3. Review the plan: `terraform plan`
-                    4. Apply the configuration: `terraform apply`
-                    """)
-                            
-            except ValueError as e:
-                with st.chat_message("assistant"):
-                    st.warning(str(e))
-                    st.markdown("""
-                    Please ensure your query is related to Azure infrastructure deployment and includes supported resources:
-                    - Virtual Machines
-                    - AKS (Azure Kubernetes Service)
-                    - Storage Accounts
-                    - Virtual Networks
-                    - Load Balancers
-                    """)
-                    st.session_state.messages.append({
-                        "role": "assistant",
-                        "content": f"⚠️ {str(e)}"
-                    })
-            except Exception as e:
-                st.error(f"Error generating Terraform configuration: {str(e)}")
+                st.info("""
+                To use this configuration:
+                1. Download the generated Terraform file
+                2. Initialize Terraform: `terraform init`
+                3. Review the plan: `terraform plan`
+                4. Apply the configuration: `terraform apply`
+                """)
+                        
+        except ValueError as e:
+            with st.chat_message("assistant"):
+                st.warning(str(e))
+                st.markdown("""
+                Please ensure your query is related to Azure infrastructure deployment and includes supported resources:
+                - Virtual Machines
+                - AKS (Azure Kubernetes Service)
+                - Storage Accounts
+                - Virtual Networks
+                - Load Balancers
+                """)
+                st.session_state.messages.append({
+                    "role": "assistant",
+                    "content": f"⚠️ {str(e)}"
+                })
+        except Exception as e:
+            st.error(f"Error generating Terraform configuration: {str(e)}")
 
 if __name__ == "__main__":
     azure_terraform_chat() 
\ No newline at end of file
@@ -1,18 +1,103 @@
 import os
-from typing import List, Dict, Tuple
-import streamlit as st
-from langchain_core.documents import Document
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_openai import OpenAIEmbeddings
-from langchain_community.vectorstores import Chroma
-from langchain_openai import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
-from langchain.chains import create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
+import re
+import hashlib
+import functools
+import contextlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, List, Dict, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+# LangChain is imported where it is first used so that importing this
+# module stays cheap and Streamlit can paint before it loads
+
+# Patterns used to route a query to template types (template file names without .tf)
+_TYPE_PATTERNS: Dict[str, re.Pattern] = {
+    "vm": re.compile(r"\b(vms?|virtual machines?|compute|instances?)\b", re.I),
+    "aks": re.compile(r"\b(aks|kubernetes|k8s|clusters?|node pools?)\b", re.I),
+    "storage": re.compile(r"\b(storage|blobs?)\b", re.I),
+    "vnet": re.compile(r"\b(vnets?|virtual networks?|subnets?|nsgs?)\b", re.I),
+    "lb": re.compile(r"\b(lbs?|load balancers?|frontends?|backend pools?)\b", re.I),
+}
+
+# System prompts, compiled into chains once per engine
+_ROUTE_SYSTEM_PROMPT = """You are a query router for an Azure Infrastructure Generator.
+Determine if the user's query is about Azure infrastructure deployment and within the scope of these resources:
+- vm: Virtual Machines
+- aks: AKS (Azure Kubernetes Service)
+- storage: Storage Accounts
+- vnet: Virtual Networks
+- lb: Load Balancers
+"""
+
+_GENERATION_SYSTEM_PROMPT = """You are a Terraform expert for an Azure Infrastructure Generator.
+First, determine if the user's query is about Azure infrastructure deployment and within the scope of these resources:
+- Virtual Machines
+- AKS (Azure Kubernetes Service)
+- Storage Accounts
+- Virtual Networks
+- Load Balancers
+
+Examples of invalid queries:
+- "What's the weather today?"
+- "Help me with my homework"
+- "How do I cook pasta?"
+
+If the query is valid, use the provided reference templates to generate a complete Terraform configuration for Azure.
+The configuration should:
+1. Include all necessary variable declarations
+2. Follow Terraform best practices
+3. Include helpful comments
+4. Be properly formatted
+5. Maintain consistency with the reference templates
+
+Respond with a JSON object only, using these keys in this order:
+{{"valid": <true/false>, "reason": "<brief explanation>", "terraform": "<Terraform code, empty if invalid>"}}
+
+Context: {context}"""
+
+# Maximum number of queries kept in the in-process caches
+CACHE_SIZE = 512
+
+def _normalize_query(query: str) -> str:
+    """Normalize a query so trivially different resubmissions share cache entries."""
+    return query.strip().lower()
+
+class _LRUCache:
+    """OrderedDict-backed LRU cache, locked because the engine is shared by every session thread."""
+
+    def __init__(self, maxsize: int = CACHE_SIZE):
+        self._data: OrderedDict = OrderedDict()
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+
+    def get(self, key: Any) -> Any:
+        """Return the cached value (or None) and mark it as most recently used."""
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key: Any, value: Any):
+        """Insert a value, evicting the oldest entry when full."""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _match_template_types(normalized_query: str) -> Tuple[str, ...]:
+    """Match template types for a normalized query against the routing patterns."""
+    return tuple(t for t, pattern in _TYPE_PATTERNS.items() if pattern.search(normalized_query))
 
 class TerraformRAGEngine:
     def __init__(self, template_dir: str):
-        """Initialize the RAG engine with template directory."""
+        """Initialize the engine with template directory."""
         self.template_dir = template_dir
         
         # Verify API key
@@ -20,184 +105,160 @@ class TerraformRAGEngine:
         if not api_key:
             raise ValueError("OpenAI API key not found in environment variables")
         
-        try:
-            self.embeddings = OpenAIEmbeddings()
-            # Test the embeddings
-            test_result = self.embeddings.embed_query("test")
-            if not test_result:
-                raise ValueError("Failed to generate embeddings")
-        except Exception as e:
-            raise ValueError(f"Failed to initialize OpenAI embeddings: {str(e)}")
-            
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
-            separators=["\n\n", "\n", " ", ""]
-        )
-        
+        from langchain_core.prompts import ChatPromptTemplate
+        from langchain_core.output_parsers import JsonOutputParser
+        from langchain_openai import ChatOpenAI
+        from schemas import QueryRoute
+
         try:
             self.llm = ChatOpenAI(model="gpt-4o", temperature=0)
+            # Cheaper model for queries the keyword router cannot classify
+            self.router_llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
         except Exception as e:
             raise ValueError(f"Failed to initialize ChatOpenAI: {str(e)}")
+
+        # Build the prompts and chains once rather than on every query
+        self._routing_chain = (
+            ChatPromptTemplate.from_messages([
+                ("system", _ROUTE_SYSTEM_PROMPT),
+                ("human", "{query}")
+            ])
+            | self.router_llm.with_structured_output(QueryRoute)
+        )
+        self._generation_chain = (
+            ChatPromptTemplate.from_messages([
+                ("system", _GENERATION_SYSTEM_PROMPT),
+                ("human", "{input}")
+            ])
+            | self.llm.bind(response_format={"type": "json_object"})
+            | JsonOutputParser()
+        )
             
-        self.vector_store = None
-        self._initialize_vector_store()
+        # The corpus is small and static, so whole templates are kept in memory
+        # and injected into the prompt instead of being embedded and retrieved
+        self.templates = self._load_templates()
+
+        # LRU caches of router verdicts keyed on query hash, and of model
+        # responses keyed on (query hash, template types)
+        self._route_cache = _LRUCache()
+        self._response_cache = _LRUCache()
+
+    def _template_entries(self) -> List[os.DirEntry]:
+        """List Terraform template files in a single directory scan."""
+        with os.scandir(self.template_dir) as it:
+            return [entry for entry in it if entry.name.endswith('.tf') and entry.is_file()]
 
-    def _validate_query(self, query: str) -> Tuple[bool, str]:
+    def _load_templates(self) -> Dict[str, str]:
+        """Load all Terraform templates keyed by template type."""
+        entries = self._template_entries()
+
+        def read(entry: os.DirEntry) -> str:
+            with open(entry.path, 'r') as f:
+                return f.read()
+
+        # Overlap the per-file read latency across templates
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            contents = list(executor.map(read, entries))
+
+        # The template type is the file name without .tf
+        return {
+            entry.name.replace('.tf', ''): content
+            for entry, content in zip(entries, contents)
+        }
+
+    async def _route_with_llm(self, query: str) -> Tuple[bool, str, List[str]]:
         """
-        Validate if the query is related to Azure infrastructure and within scope.
-        Returns a tuple of (is_valid, reason).
+        Validate and classify a query that matched no keyword pattern using the router model.
+        Returns a tuple of (is_valid, reason, template_types).
         """
-        validation_prompt = ChatPromptTemplate.from_messages([
-            ("system", """You are a query validator for an Azure Infrastructure Generator.
-            Determine if the user's query is about Azure infrastructure deployment and within the scope of these resources:
-            - Virtual Machines
-            - AKS (Azure Kubernetes Service)
-            - Storage Accounts
-            - Virtual Networks
-            - Load Balancers
-
-            Respond with only true or false, followed by a brief reason.
-            Format: valid: <true/false>
-            reason: <brief explanation>
-
-            Examples of valid queries:
-            - "Create a virtual machine with 2 cores"
-            - "Set up a storage account with private endpoints"
-            - "Deploy an AKS cluster with 3 nodes"
-
-            Examples of invalid queries:
-            - "What's the weather today?"
-            - "Help me with my homework"
-            - "How do I cook pasta?"
-            """),
-            ("human", "{query}")
-        ])
+        route = await self._routing_chain.ainvoke({"query": query})
+        template_types = [t.strip().lower() for t in route.types if t.strip().lower() in _TYPE_PATTERNS]
+        return route.valid, route.reason, template_types
 
-        try:
-            result = self.llm.invoke(validation_prompt.format(query=query))
-            response_lines = result.content.strip().lower().split('\n')
-            
-            is_valid = False
-            reason = "Invalid query format"
-            
-            for line in response_lines:
-                if line.startswith('valid:'):
-                    is_valid = 'true' in line.lower()
-                elif line.startswith('reason:'):
-                    reason = line[7:].strip()
-            
-            return is_valid, reason
-        except Exception as e:
-            return False, f"Error validating query: {str(e)}"
-
-    def _load_templates(self) -> List[Document]:
-        """Load all Terraform templates as documents."""
-        documents = []
-        for filename in os.listdir(self.template_dir):
-            if filename.endswith('.tf'):
-                file_path = os.path.join(self.template_dir, filename)
-                with open(file_path, 'r') as f:
-                    content = f.read()
-                    # Store the template type in metadata
-                    template_type = filename.replace('.tf', '')
-                    doc = Document(
-                        page_content=content,
-                        metadata={"source": filename, "type": template_type}
-                    )
-                    documents.append(doc)
-        return documents
-
-    def _initialize_vector_store(self):
-        """Initialize the vector store with chunked documents."""
-        documents = self._load_templates()
-        splits = self.text_splitter.split_documents(documents)
-        self.vector_store = Chroma.from_documents(
-            documents=splits,
-            embedding=self.embeddings
-        )
+    async def _get_relevant_templates(self, query: str, notices: Optional[List[str]] = None) -> List[str]:
+        """
+        Get relevant template types based on keyword patterns, falling back to the router model.
+        Problems the caller should show the user are appended to notices.
+        """
+        relevant_types = list(_match_template_types(_normalize_query(query)))
+        if relevant_types:
+            return relevant_types
 
-    def _get_relevant_templates(self, query: str) -> List[str]:
-        """Get relevant template types based on the query."""
-        try:
-            template_prompt = ChatPromptTemplate.from_messages([
-                ("system", """Analyze the user's infrastructure requirements and identify which Azure resource types are needed.
-                Return a comma-separated list of resource types from these options only: virtual_machine, aks, storage, vnet, lb.
-                Example: "storage,vnet" if user needs storage and networking."""),
-                ("human", "{input}")
-            ])
-            
-            chain = template_prompt | self.llm
-            result = chain.invoke({"input": query})
-            
-            if not result.content:
-                return ["virtual_machine", "storage"]  # Default to basic resources if no clear match
-                
-            return [t.strip() for t in result.content.split(',')]
-            
-        except Exception as e:
-            st.error(f"Error in template selection: {str(e)}")
-            return ["virtual_machine", "storage"]  # Default to basic resources on error
+        query_hash = hashlib.sha1(_normalize_query(query).encode('utf-8')).hexdigest()
+        route = self._route_cache.get(query_hash)
+        if route is None:
+            try:
+                route = await self._route_with_llm(query)
+            except Exception as e:
+                # The engine runs off the Streamlit script thread, so the UI renders the notice
+                logger.exception("Error in template selection")
+                if notices is not None:
+                    notices.append(f"Error in template selection, using default templates: {str(e)}")
+                return ["vm", "storage"]  # Default to basic resources on error
+            self._route_cache.put(query_hash, route)
 
-    def generate_terraform(self, query: str) -> str:
-        """Generate Terraform configuration using RAG."""
-        try:
-            # First, validate the query
-            is_valid, reason = self._validate_query(query)
-            if not is_valid:
-                raise ValueError(f"Query is out of scope: {reason}")
+        is_valid, reason, relevant_types = route
+        if not is_valid:
+            raise ValueError(f"Query is out of scope: {reason}")
 
-            # Get relevant template types
-            relevant_types = self._get_relevant_templates(query)
-            
-            # Create a retriever that focuses on relevant templates
-            retriever = self.vector_store.as_retriever(
-                search_type="similarity",
-                search_kwargs={
-                    "k": 5,
-                    "filter": {"type": {"$in": relevant_types}}
-                }
-            )
-
-            # Create the prompt for generating Terraform code
-            prompt = ChatPromptTemplate.from_messages([
-                ("system", """You are a Terraform expert. Using the provided reference templates, generate a complete Terraform configuration for Azure.
-                The configuration should:
-                1. Include all necessary variable declarations
-                2. Follow Terraform best practices
-                3. Include helpful comments
-                4. Be properly formatted
-                5. Maintain consistency with the reference templates
-                
-                Context: {context}"""),
-                ("human", "{input}")
-            ])
+        return relevant_types or ["vm", "storage"]  # Default to basic resources if no clear match
 
-            # Create a chain to combine documents
-            document_chain = create_stuff_documents_chain(
-                llm=self.llm,
-                prompt=prompt,
-            )
+    async def generate_terraform_stream(self, query: str, notices: Optional[List[str]] = None) -> AsyncIterator[str]:
+        """
+        Validate the query and stream the generated Terraform configuration as it is decoded.
+        Non-fatal problems for the user (e.g. a router failure) are appended to notices.
+        """
+        try:
+            # Pick template types, rejecting clearly out-of-scope queries before generation
+            relevant_types = await self._get_relevant_templates(query, notices)
+
+            query_hash = hashlib.sha1(_normalize_query(query).encode('utf-8')).hexdigest()
+            cache_key = (query_hash, tuple(relevant_types))
+            response = self._response_cache.get(cache_key)
+            emitted = 0
+            if response is None:
+                response = {}
+                # Close the stream (and its HTTP response) even when breaking out early
+                async with contextlib.aclosing(self._stream_response(query, relevant_types)) as partials:
+                    async for response in partials:
+                        if response.get("valid") is True:
+                            terraform = response.get("terraform") or ""
+                            if len(terraform) > emitted:
+                                yield terraform[emitted:]
+                                emitted = len(terraform)
+                        elif response.get("valid") is False and "terraform" in response:
+                            # The reason is complete once the terraform key starts; skip the rest
+                            break
 
-            # Create the retrieval chain
-            retrieval_chain = create_retrieval_chain(
-                retriever,
-                document_chain
-            )
+                self._response_cache.put(cache_key, response)
 
-            # Generate the response
-            response = retrieval_chain.invoke({
-                "input": query
-            })
+            if not response.get("valid"):
+                raise ValueError(f"Query is out of scope: {response.get('reason', 'Invalid query format')}")
 
-            if "answer" not in response:
+            if not response.get("terraform"):
                 raise ValueError("No response generated from the model")
 
-            return response["answer"]
+            # Cached responses are emitted in one piece
+            if len(response["terraform"]) > emitted:
+                yield response["terraform"][emitted:]
             
         except ValueError as e:
             # Re-raise validation errors to be handled by the UI
             raise
         except Exception as e:
-            st.error(f"Error in generate_terraform: {str(e)}")
-            raise Exception(f"Failed to generate Terraform configuration: {str(e)}") 
\ No newline at end of file
+            logger.exception("Error in generate_terraform")
+            raise Exception(f"Failed to generate Terraform configuration: {str(e)}")
+
+    async def _stream_response(self, query: str, relevant_types: List[str]) -> AsyncIterator[Dict]:
+        """Stream the partially parsed validation/generation response for the relevant templates."""
+        # Inject the selected templates whole; no embedding or retrieval hop
+        context = "REFERENCE TEMPLATES:\n\n" + "\n\n---\n\n".join(
+            self.templates[t] for t in relevant_types if t in self.templates
+        )
+
+        # Stream the response; each item is the JSON object parsed so far
+        async for partial in self._generation_chain.astream({
+            "input": query,
+            "context": context
+        }):
+            yield partial
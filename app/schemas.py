@@ -0,0 +1,8 @@
+from typing import List
+from pydantic import BaseModel, Field
+
+class QueryRoute(BaseModel):
+    """Router verdict for a query that matched no keyword pattern."""
+    valid: bool = Field(description="Whether the query asks for supported Azure infrastructure")
+    reason: str = Field(description="Brief explanation of the verdict")
+    types: List[str] = Field(description="Resource types needed, from: vm, aks, storage, vnet, lb")
@@ -0,0 +1,186 @@
+import os
+import asyncio
+
+import pytest
+
+from rag_engine import _match_template_types, _normalize_query
+
+@pytest.mark.parametrize("query, expected", [
+    ("Create a virtual machine with 2 cores", ("vm",)),
+    ("Create 2 VMs behind a load balancer in a VNet", ("vm", "vnet", "lb")),
+    ("Deploy an AKS cluster with 3 nodes", ("aks",)),
+    ("Deploy containers to kubernetes", ("aks",)),
+    ("Set up a storage account with private endpoints", ("storage",)),
+    ("Create a blob container for backups", ("storage",)),
+    ("Create a virtual network with two subnets for web and database tiers", ("vnet",)),
+])
+def test_routing_matches_resource_keywords(query, expected):
+    assert _match_template_types(_normalize_query(query)) == expected
+
+@pytest.mark.parametrize("query", [
+    "What's my bank account balance?",
+    "How do I cook pasta?",
+    "What's the weather today?",
+])
+def test_routing_leaves_unrelated_queries_to_the_router(query):
+    assert _match_template_types(_normalize_query(query)) == ()
+
+class FakeGenerationChain:
+    """Stands in for the gpt-4o chain, yielding a fixed sequence of partially parsed responses."""
+
+    def __init__(self, partials):
+        self.partials = partials
+        self.calls = []
+        self.yielded = 0
+        self.closed = False
+
+    async def astream(self, inputs):
+        self.calls.append(inputs)
+        try:
+            for partial in self.partials:
+                self.yielded += 1
+                yield partial
+        finally:
+            self.closed = True
+
+class FakeRoutingChain:
+    """Stands in for the gpt-4o-mini router."""
+
+    def __init__(self, route):
+        self.route = route
+        self.calls = []
+
+    async def ainvoke(self, inputs):
+        self.calls.append(inputs)
+        return self.route
+
+@pytest.fixture
+def engine(monkeypatch):
+    from rag_engine import TerraformRAGEngine
+
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    template_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'templates')
+    return TerraformRAGEngine(template_dir)
+
+def collect(engine, query):
+    async def run():
+        return [chunk async for chunk in engine.generate_terraform_stream(query)]
+    return asyncio.run(run())
+
+def test_load_templates_keys_by_file_name(engine):
+    assert sorted(engine.templates) == ["aks", "lb", "storage", "vm", "vnet"]
+
+def test_stream_yields_new_terraform_suffixes(engine):
+    engine._generation_chain = FakeGenerationChain([
+        {"valid": True},
+        {"valid": True, "reason": "VM request"},
+        {"valid": True, "reason": "VM request", "terraform": "resource"},
+        {"valid": True, "reason": "VM request", "terraform": "resource \"azurerm_linux_virtual_machine\""},
+    ])
+
+    chunks = collect(engine, "Create a virtual machine")
+
+    assert chunks == ["resource", " \"azurerm_linux_virtual_machine\""]
+    # Only the routed template is injected into the prompt
+    context = engine._generation_chain.calls[0]["context"]
+    assert engine.templates["vm"] in context
+    assert engine.templates["aks"] not in context
+
+def test_repeated_query_is_served_from_cache(engine):
+    engine._generation_chain = FakeGenerationChain([
+        {"valid": True, "reason": "VM request", "terraform": "resource"},
+        {"valid": True, "reason": "VM request", "terraform": "resource {}"},
+    ])
+
+    assert collect(engine, "Create a virtual machine") == ["resource", " {}"]
+    # Normalized resubmission hits the cache and is emitted in one piece
+    assert collect(engine, "  create a VIRTUAL machine ") == ["resource {}"]
+    assert len(engine._generation_chain.calls) == 1
+
+def test_invalid_verdict_raises_and_closes_stream(engine):
+    engine._generation_chain = FakeGenerationChain([
+        {"valid": False, "reason": "Not about Azure"},
+        {"valid": False, "reason": "Not about Azure", "terraform": ""},
+        {"valid": False, "reason": "Not about Azure", "terraform": "never read"},
+    ])
+
+    with pytest.raises(ValueError, match="Query is out of scope: Not about Azure"):
+        collect(engine, "Create a virtual machine for my homework")
+    # The stream stops once the reason is complete and is closed, not drained
+    assert engine._generation_chain.yielded == 2
+    assert engine._generation_chain.closed
+
+def test_router_rejects_unmatched_query_before_generation(engine):
+    from schemas import QueryRoute
+
+    engine._routing_chain = FakeRoutingChain(QueryRoute(valid=False, reason="Cooking question", types=[]))
+    engine._generation_chain = FakeGenerationChain([])
+
+    with pytest.raises(ValueError, match="Query is out of scope: Cooking question"):
+        collect(engine, "How do I cook pasta?")
+    assert engine._generation_chain.calls == []
+
+    # The verdict is cached per query
+    with pytest.raises(ValueError):
+        collect(engine, "How do I cook pasta?")
+    assert len(engine._routing_chain.calls) == 1
+
+class FailingRoutingChain:
+    """Router stand-in whose call fails, e.g. on an API error."""
+
+    async def ainvoke(self, inputs):
+        raise RuntimeError("router unavailable")
+
+def test_router_failure_falls_back_to_defaults_and_reports_notice(engine):
+    engine._routing_chain = FailingRoutingChain()
+    engine._generation_chain = FakeGenerationChain([
+        {"valid": True, "reason": "Infrastructure request", "terraform": "resource {}"},
+    ])
+    notices = []
+
+    async def run():
+        return [chunk async for chunk in engine.generate_terraform_stream("Provision something in Azure", notices)]
+
+    assert asyncio.run(run()) == ["resource {}"]
+    assert notices == ["Error in template selection, using default templates: router unavailable"]
+    context = engine._generation_chain.calls[0]["context"]
+    assert engine.templates["vm"] in context
+    assert engine.templates["storage"] in context
+    assert engine.templates["aks"] not in context
+
+def test_router_success_filters_types_and_routes_context(engine):
+    from schemas import QueryRoute
+
+    engine._routing_chain = FakeRoutingChain(
+        QueryRoute(valid=True, reason="Networking request", types=[" VNET", "Lb", "firewall"])
+    )
+    engine._generation_chain = FakeGenerationChain([
+        {"valid": True, "reason": "Networking request", "terraform": "resource {}"},
+    ])
+
+    assert collect(engine, "Give my web tier a private address space") == ["resource {}"]
+
+    # Unknown types are dropped and mixed-case ones normalized before retrieval
+    context = engine._generation_chain.calls[0]["context"]
+    assert engine.templates["vnet"] in context
+    assert engine.templates["lb"] in context
+    for template_type in ("vm", "aks", "storage"):
+        assert engine.templates[template_type] not in context
+
+def test_router_success_without_types_uses_defaults(engine):
+    from schemas import QueryRoute
+
+    engine._routing_chain = FakeRoutingChain(
+        QueryRoute(valid=True, reason="Azure request", types=["firewall"])
+    )
+    engine._generation_chain = FakeGenerationChain([
+        {"valid": True, "reason": "Azure request", "terraform": "resource {}"},
+    ])
+
+    assert collect(engine, "Provision something in Azure") == ["resource {}"]
+
+    context = engine._generation_chain.calls[0]["context"]
+    assert engine.templates["vm"] in context
+    assert engine.templates["storage"] in context
+    for template_type in ("aks", "vnet", "lb"):
+        assert engine.templates[template_type] not in context